@@ -12,17 +12,30 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import copy
+import codecs
+import concurrent.futures
 from datetime import datetime
+import functools
 import logging
 import os
 import re
+import shlex
 import subprocess
+import time
 import traceback
 import uuid
 
 from sampletester import testenv
 
+# Distinguishes "directive not defined" from any legitimate builtin value.
+_UNKNOWN_DIRECTIVE = object()
+
+# Hoisted subprocess attributes, so each external call skips the repeated
+# module attribute lookups on its hot path.
+_Popen = subprocess.Popen
+_PIPE = subprocess.PIPE
+_STDOUT = subprocess.STDOUT
+
 
 class TestCase:
   # The kwarg/YAML list element key containing a custom message for the various
@@ -31,10 +44,13 @@ class TestCase:
 
   def __init__(self, environment: testenv.Base,
                idx: int, label: str,
-               setup, case, teardown):
+               setup, case, teardown,
+               serial: bool = False, batch_calls: bool = False):
     self.failures = []
     self.errors = []
-    self.output = ""
+    # A list of chunks, joined in get_output; appending to a str instead would
+    # copy the whole buffer each time.
+    self.output = []
 
     self.environment = environment
     self.idx = idx
@@ -43,11 +59,50 @@ class TestCase:
     self.case = case
     self.teardown = teardown
 
+    # Whether this case must run in the main process (see `runner.run_all`).
+    self.serial = serial
+
+    # Whether consecutive call_may_fail directives may run their children
+    # concurrently (see `_run_call_batch`).
+    self.batch_calls = batch_calls
+
+    # Environment variables resolved so far; the environment does not change
+    # during a run, so each variable is fetched from os.environ only once.
+    self._env_cache = {}
+
     self.last_return_code = 0
     self.last_call_output = ""
+    # Lazily computed lowercasing of last_call_output, for the
+    # case-insensitive contains checks; invalidated on each new call.
+    self._last_call_output_lower = None
+    # Wall-clock times, consumed by the xunit report and the testplan
+    # bookkeeping; duration_ns is the monotonic high-resolution duration of
+    # `run`, unaffected by clock adjustments.
     self.start_time = None
     self.end_time = None
-
+    self.duration_ns = None
+
+    # The builtins (and thus the local symbols) contain closures over `self`,
+    # which cannot be pickled; we defer creating them until `run` so that
+    # TestCase instances can be dispatched to worker processes.
+    self.builtins = None
+    self.yaml_preps = None
+    self.local_symbols = None
+
+  def __getstate__(self):
+    # Drop the unpicklable builtin bindings; `run` re-creates them as needed.
+    state = self.__dict__.copy()
+    state['builtins'] = None
+    state['yaml_preps'] = None
+    state['local_symbols'] = None
+    return state
+
+  def _bind_builtins(self):
+    """Creates the builtin bindings available to this test case.
+
+    Called from `run` rather than `__init__` so that a not-yet-run TestCase
+    remains picklable for parallel execution.
+    """
     # The key is the external binding available through `code` and directly through yaml keys.
     #
     # The value is a pair. The first element is the test variable or
@@ -55,7 +110,7 @@ class TestCase:
     # that returns a pair of ([arguments], {kwargs}) for passing to the function; if
     # the yaml_prep returns None, the test function is not called (this is
     # useful to provide an alternate representation in the YAML)
-    self.builtins = {
+    builtins = {
         ### Variables: meta info about the test case, last output
         "testcase_num": (self.idx, None),
         "testcase_id": (self.label, None),
@@ -115,9 +170,11 @@ class TestCase:
 
     }
 
-    self.local_symbols = {}
-    for symbol, info in self.builtins.items():
-      self.local_symbols[symbol] = info[0]
+    # Split the pairs into parallel maps so the hot dispatch path can look up
+    # a callable or a yaml_prep directly instead of indexing into a tuple.
+    self.builtins = {symbol: info[0] for symbol, info in builtins.items()}
+    self.yaml_preps = {symbol: info[1] for symbol, info in builtins.items()}
+    self.local_symbols = dict(self.builtins)
 
   def get_failures(self):
     return [(status, message.format(*args))
@@ -160,13 +217,13 @@ class TestCase:
   def print_out(self, msg, *args):
     """Formats `msg` according to `args` and records it in the TestCase output."""
     try:
-      self.output += self.format_string(str(msg), *args) + "\n"
+      self.output.append(self.format_string(str(msg), *args) + "\n")
     except Exception as e:
       raise
 
   def execute(self, code):
     """Executes YAML directive "code"."""
-    exec(code, None, self.local_symbols)
+    exec(_compile_code(code), None, self.local_symbols)
 
   def get_uuid(self):
     """Gets a UUID via code."""
@@ -180,7 +237,12 @@ class TestCase:
   def get_env(self, env_var):
     """Gets an environment variable via code."""
     # TODO: Catch key error
-    return os.environ[env_var]
+    try:
+      return self._env_cache[env_var]
+    except KeyError:
+      value = os.environ[env_var]
+      self._env_cache[env_var] = value
+      return value
 
   def yaml_get_env(self, parts):
     """Gets an environment variable via YAML."""
@@ -205,7 +267,7 @@ class TestCase:
        self.local_symbols[variable_name] = None
 
     text = self.last_call_output
-    match = re.search(pattern, text)
+    match = _compile(pattern).search(text)
     if match and match.groups():
       captures = match.groups()
       if variable:
@@ -238,29 +300,60 @@ class TestCase:
   def _call_external(self, cmd, chdir=None):
     self.last_return_code = 0
     self.last_call_output = ""
+    self._last_call_output_lower = None
 
-    try:
-      self.print_out("\n# Calling: " + cmd)
-      out = subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True, cwd=chdir)
-      return_code = 0
-    except subprocess.CalledProcessError as e:
-      return_code = e.returncode
-      out = e.output
+    return_code, new_output = _execute_command(cmd, chdir)
+    return self._merge_call_result(cmd, return_code, new_output)
+
+  def _merge_call_result(self, cmd, return_code, new_output):
+    """Records the result of one external call in this TestCase."""
+    self.print_out("\n# Calling: " + cmd)
+    if return_code != 0:
       # TODO(vchudnov): Prefix the error output with comments
-      self.output += "# ... call did not succeed  "
-      # return return_code, out
-    except Exception as e:
-      raise
+      self.output.append("# ... call did not succeed  ")
 
-    new_output = out.decode("utf-8")
     self.last_return_code = return_code
     # TODO: De-dupe the following. Either some accessor magic, or have it live in local_symbols
     self.last_call_output = new_output
+    self._last_call_output_lower = None
     self.local_symbols['_last_call_output'] = new_output
 
-    self.output += new_output
+    self.output.append(new_output)
     return return_code, new_output
 
+  def _run_call_batch(self, compiled_segments):
+    """Runs consecutive `call_may_fail` segments with concurrent children.
+
+    Only cases that set `batch_calls` use this, and only for segments whose
+    arguments read no case state: `call_may_fail` cannot fail the test, but
+    the children's external side effects do interleave, so opting in asserts
+    that these calls are independent of each other. Each call is resolved in
+    its own task at execution time (threads suffice: the callers just block
+    on pipe reads and waits), and results are merged in submission order, so
+    captured output, `last_call_output`, and `last_return_code` match a
+    serial run of independent calls.
+    """
+    self.last_return_code = 0
+    self.last_call_output = ""
+    self._last_call_output_lower = None
+
+    def resolve_and_execute(compiled_segment):
+      _, _, prep, segment = compiled_segment
+      args, kwargs = prep(segment)
+      try:
+        call, chdir = self.environment.get_call(*(args or []),
+                                                **(kwargs or {}))
+      except Exception as e:
+        raise CallError('could not resolve call: {}'.format(str(e)))
+      return call, _execute_command(call, chdir)
+
+    max_workers = min(len(compiled_segments), os.cpu_count() or 1)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+      results = list(pool.map(resolve_and_execute, compiled_segments))
+
+    for call, (return_code, new_output) in results:
+      self._merge_call_result(call, return_code, new_output)
+
   def call_no_error(self, *args, **kwargs):
     """Invokes `cmd` (formatted with `args`), failing/soft-aborting if error."""
     return_code, out = self.call_allow_error(*args, **kwargs)
@@ -306,7 +399,23 @@ class TestCase:
         condition = lambda substr: self.last_output_contains(substr, **kwargs)
       else:
         condition = lambda substr: not self.last_output_contains(substr, **kwargs)
-      self._check_several(check, which, condition, message, values)
+
+      # "contains any" and "excludes all" both reduce to whether at least one
+      # value is present, which a single combined-pattern scan of the output
+      # answers without testing each value separately.
+      case_sensitive = kwargs.get('case_sensitive', False)
+      result = None
+      if (which == any and contains) or (which == all and not contains):
+        if case_sensitive:
+          text, needles = self.last_call_output, values
+        else:
+          if self._last_call_output_lower is None:
+            self._last_call_output_lower = self.last_call_output.lower()
+          text = self._last_call_output_lower
+          needles = [value.lower() for value in values]
+        present = _contains_any(text, needles)
+        result = present if contains else not present
+      self._check_several(check, which, condition, message, values, result)
     return checker
 
   # Assertion on the return value of the last call indicating success.
@@ -319,7 +428,8 @@ class TestCase:
     message = message or "expected last call to fail"
     self.assert_that(self.last_return_code != 0, message, *args)
 
-  def _check_several(self, check, which, condition, message, values):
+  def _check_several(self, check, which, condition, message, values,
+                     result=None):
     """Utility function for the `expect_*` and `assert_*` calls.
 
     Runs `check` on `condition` for each element of `values`, reporting on
@@ -335,6 +445,8 @@ class TestCase:
       values: the values to be tested using condition. This check will pass or
          fail depending on the result of `which` applies to the result of
          `condition` on these `values`.
+      result: if not None, the precomputed outcome of applying `which` to
+         `condition` over `values`; `condition` is then not called.
     """
     default_message = len(message) == 0
     label_check = 'required' if check == self.assert_that else 'expected' if check == self.expect else None
@@ -345,17 +457,44 @@ class TestCase:
     if default_message:
       message = ('{}, but did not find, {} the following values in the preceding output: {}'
                  .format(label_check, label_which, values))
-    check(which([condition(substr) for substr in values]), message)
+    if result is None:
+      # A generator lets any/all stop testing values once the outcome is
+      # decided.
+      result = which(condition(substr) for substr in values)
+    check(result, message)
 
   def run(self):
+    self._bind_builtins()
+    start_ns = time.perf_counter_ns()
     self.start_time = datetime.now()
     status_message = ""
     log_entry_prefix = "---- Test case {:d}: \"{:s}\"".format(
         self.idx, self.label)
 
     def run_segments_of(stage_spec):
-      for spec_segment in stage_spec:
-        self.run_segment(spec_segment)
+      compiled = self._compile_stage(stage_spec)
+      idx = 0
+      while idx < len(compiled):
+        # If the case opted in, runs of two or more consecutive call_may_fail
+        # segments whose arguments read no case state execute their children
+        # concurrently (see _run_call_batch).
+        batch_end = idx
+        if self.batch_calls:
+          while (batch_end < len(compiled) and
+                 compiled[batch_end][0] == "call_may_fail" and
+                 not _reads_case_state(compiled[batch_end][3])):
+            batch_end += 1
+        if batch_end - idx > 1:
+          self._run_call_batch(compiled[idx:batch_end])
+          idx = batch_end
+          continue
+
+        _, fn, prep, segment = compiled[idx]
+        idx += 1
+        args, kwargs = prep(segment)
+        if args is None and kwargs is None:
+          continue
+        fn(*(args or []), **(kwargs or {}))
 
     try:
       for stage_name, stage_spec in [("SETUP", self.setup), ("TEST", self.case)]:
@@ -405,51 +544,65 @@ class TestCase:
         self.record_error(status, description)
         self.print_out("# EXCEPTION!! " + short_description)
 
-    print_output = True
-    if len(self.failures) > 0:
-      logging.info(log_entry_prefix + " FAILED --------------------")
-      for failure in self.failures:
-        logging.info("    {}: {}".format(
-            failure[0], self.format_string(failure[1], *failure[2])))
-        print_output = True
-    elif len(self.errors) > 0:
-      logging.info(log_entry_prefix + " ERRORED --------------------")
-      for error in self.errors:
-        logging.info("    {}: (check state: clean-up did not finish) {}".format(
-            error[0], self.format_string(error[1], *error[2])))
-        print_output = True
-    else:
-      logging.info(log_entry_prefix + " PASSED ------------------------------")
-    if print_output:
+    # The status formatting (symbol interpolation, reindenting the whole
+    # output buffer) is wasted work if the log record would be dropped, so
+    # check the level first.
+    if logging.getLogger().isEnabledFor(logging.INFO):
+      if len(self.failures) > 0:
+        lines = [log_entry_prefix + " FAILED --------------------"]
+        lines.extend("    {}: {}".format(
+            failure[0], self.format_string(failure[1], *failure[2]))
+                     for failure in self.failures)
+        logging.info("%s", "\n".join(lines))
+      elif len(self.errors) > 0:
+        lines = [log_entry_prefix + " ERRORED --------------------"]
+        lines.extend(
+            "    {}: (check state: clean-up did not finish) {}".format(
+                error[0], self.format_string(error[1], *error[2]))
+            for error in self.errors)
+        logging.info("%s", "\n".join(lines))
+      else:
+        logging.info("%s PASSED ------------------------------",
+                     log_entry_prefix)
       logging.info("    Output:")
-      logging.info(self.get_output(4, "| ") + "\n")
+      logging.info("%s\n", self.get_output(4, "| "))
 
     self.end_time = datetime.now()
+    self.duration_ns = time.perf_counter_ns() - start_ns
     return len(self.failures) + len(self.errors)
 
   def get_output(self, indent=0, header=""):
-    return reindent(copy.deepcopy(self.output), indent, header)
-
-  def run_segment(self, spec_segment):
-    if len(spec_segment) > 1:
-      raise ConfigError
+    return reindent("".join(self.output), indent, header)
 
-    for directive, segment in spec_segment.items():
-      if directive not in self.builtins:
-        raise ConfigError("unknown YAML directive: " + str(directive))
+  def _compile_stage(self, stage_spec):
+    """Pre-parses one stage (setup/test/teardown) into dispatchable tuples.
 
-      howto = self.builtins[directive]
-      if howto[1] == None:
-        raise ConfigError("directive only available inside a code directive: " +
-                          directive)
-
-      args, kwargs = howto[1](segment)
-      if args is None and kwargs is None:
-        return
-      args = args or []
-      kwargs = kwargs or {}
-
-      howto[0](*args, **kwargs)
+    Resolves and validates every directive in `stage_spec` up front, raising
+    `ConfigError` for malformed segments, and returns a list of
+    `(directive, fn, yaml_prep, segment)` tuples so that executing the stage
+    is a tight iteration with no per-segment dict traversal. Called from `run` (rather
+    than `__init__`) to keep not-yet-run TestCases picklable and to attribute
+    configuration errors to the stage they occur in.
+    """
+    compiled = []
+    for spec_segment in stage_spec:
+      if len(spec_segment) > 1:
+        raise ConfigError
+
+      for directive, segment in spec_segment.items():
+        # A sentinel rather than a membership test: one hash lookup instead
+        # of two, and builtin values may legitimately be falsy.
+        fn = self.builtins.get(directive, _UNKNOWN_DIRECTIVE)
+        if fn is _UNKNOWN_DIRECTIVE:
+          raise ConfigError("unknown YAML directive: " + str(directive))
+
+        prep = self.yaml_preps[directive]
+        if prep is None:
+          raise ConfigError(
+              "directive only available inside a code directive: " + directive)
+
+        compiled.append((directive, fn, prep, segment))
+    return compiled
 
   #### Helper methods
 
@@ -457,7 +610,9 @@ class TestCase:
     case_sensitive = kwargs.get('case_sensitive', False)
     if case_sensitive:
       return substr in self.last_call_output
-    return substr.lower() in self.last_call_output.lower()
+    if self._last_call_output_lower is None:
+      self._last_call_output_lower = self.last_call_output.lower()
+    return substr.lower() in self._last_call_output_lower
 
   def format_string(self, msg, *args):
     """Returns `msg` formatted with `*args`.
@@ -467,13 +622,19 @@ class TestCase:
     automatically adds any `{}` placeholders needed to match `len(args)`.
     """
 
-    msg = interpolate_symbols(msg, self.environment.get_symbol)
-
-    if len(args) == 0:
-      return msg
+    # Fast path: no braces means no symbols to interpolate and no
+    # placeholders to fill.
+    if '{' not in msg:
+      if len(args) == 0:
+        return msg
+      count = 0
+    else:
+      msg = interpolate_symbols(msg, self.environment.get_symbol)
+      if len(args) == 0:
+        return msg
 
-    # TODO: Allow for escaping braces.
-    count = msg.count("{}")
+      # TODO: Allow for escaping braces.
+      count = _placeholder_count(msg)
 
     # Add any missing placeholders
     missing = len(args) - count
@@ -600,6 +761,109 @@ class TestCase:
     """
     return [self.local_symbols.get(p, '"{}"'.format(str(p))) for p in strings]
 
+def _execute_command(cmd, chdir=None):
+  """Executes `cmd` and returns its (return code, decoded output).
+
+  Reads the child's output as it is produced instead of buffering all of it
+  before returning; the incremental decoder keeps multi-byte UTF-8 sequences
+  split across chunks intact. Thread-safe, so batched calls can share it.
+  """
+  argv = _as_argv(cmd)
+  process = None
+  if argv:
+    try:
+      process = _Popen(argv, stdout=_PIPE, stderr=_STDOUT,
+                       cwd=chdir, bufsize=1 << 16)
+    except OSError:
+      # e.g. command not found: fall through so the shell reports it the
+      # way it always has (a diagnostic message and exit code 127).
+      process = None
+  if process is None:
+    process = _Popen(cmd, stdout=_PIPE, stderr=_STDOUT, shell=True,
+                     cwd=chdir, bufsize=1 << 16)
+  decoder = codecs.getincrementaldecoder("utf-8")()
+  chunks = []
+  for data in iter(lambda: process.stdout.read(1 << 16), b""):
+    chunks.append(decoder.decode(data))
+  chunks.append(decoder.decode(b"", final=True))
+  return_code = process.wait()
+  return return_code, "".join(chunks)
+
+
+def _reads_case_state(segment):
+  """Whether a YAML segment's arguments reference per-call case state.
+
+  A segment that names `_last_call_output` as a variable depends on the
+  result of the call preceding it, so it must not be batched.
+  """
+  if isinstance(segment, dict):
+    if segment.get('variable') == '_last_call_output':
+      return True
+    return any(_reads_case_state(value) for value in segment.values())
+  if isinstance(segment, list):
+    return any(_reads_case_state(value) for value in segment)
+  return False
+
+
+# Characters that make a command depend on shell interpretation (pipes,
+# redirection, globbing, variable expansion, and the like).
+_SHELL_METACHARACTERS = frozenset('|&;<>()$`\\*?[]{}~#!\n')
+
+def _as_argv(cmd):
+  """Returns `cmd` split into an argv list, or None if it needs a shell.
+
+  Commands free of shell metacharacters can be exec'ed directly, skipping the
+  fork of /bin/sh that shell=True incurs for every call.
+  """
+  if _SHELL_METACHARACTERS.isdisjoint(cmd):
+    try:
+      return shlex.split(cmd)
+    except ValueError:
+      pass
+  return None
+
+
+def _contains_any(text, values):
+  """Tests whether `text` contains at least one of `values`.
+
+  The values are combined into a single alternation pattern so that the regex
+  engine scans `text` once, rather than once per value. For case-insensitive
+  checks, callers pass `text` and `values` already lowercased (mirroring
+  `last_output_contains`; the regex engine's own case folding matches a
+  slightly different set, and the caller can reuse its cached lowering).
+  """
+  if not values:
+    return False
+  pattern = "|".join(re.escape(value) for value in values)
+  return _compile(pattern).search(text) is not None
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_code(source):
+  """Compiles the source of a `code` directive to a code object.
+
+  exec on a string re-parses it every time; caching the compiled code object
+  makes repeated identical `code` blocks (common in table-driven suites) cost
+  only the execution.
+  """
+  return compile(source, '<sampletester-code>', 'exec')
+
+
+@functools.lru_cache(maxsize=512)
+def _placeholder_count(msg):
+  """Counts the '{}' placeholders in `msg`, memoized for reused format strings."""
+  return msg.count("{}")
+
+
+@functools.lru_cache(maxsize=512)
+def _compile(pattern):
+  """Compiles `pattern`, caching the result.
+
+  Unlike the re module's internal cache, this one is not cleared when full, so
+  hot user-supplied patterns never get recompiled.
+  """
+  return re.compile(pattern)
+
 ### Helpers for substituting symbol values
 
 _interpolated_symbol_re = re.compile('{([^}]+)}')
@@ -630,10 +894,10 @@ class CallError(Exception):
 
 # heavily adapted from from https://www.oreilly.com/library/view/python-cookbook/0596001673/ch03s12.html
 def reindent(s, numSpaces, prompt):
-  s = s.split("\n")
-  s = [(numSpaces * " ") + prompt + line for line in s]
-  s = "\n".join(s)
-  return s
+  # A single replace pass is equivalent to splitting, prefixing each line, and
+  # rejoining, without materializing the intermediate list.
+  prefix = (numSpaces * " ") + prompt
+  return prefix + s.replace("\n", "\n" + prefix)
 
 
 def log_raise(log_fn, exception, message):
@@ -89,12 +89,20 @@ def main():
 
   verbosity = VERBOSITY_LEVELS[args.verbosity]
   quiet = verbosity == summary.Detail.NONE
-  visitor = testplan.MultiVisitor(runner.Visitor(args.fail_fast),
-                                  summary.SummaryVisitor(verbosity,
-                                                         not args.suppress_failures,
-                                                         debug=DEBUGME))
+  summary_visitor = summary.SummaryVisitor(verbosity,
+                                           not args.suppress_failures,
+                                           debug=DEBUGME)
   try:
-    success = manager.accept(visitor)
+    if args.jobs > 1:
+      # Parallel runs defer case execution to the end of each suite, so an
+      # interleaved running summary would read case status before the cases
+      # run; print the summary in a second pass after the run completes.
+      success = manager.accept(runner.Visitor(args.fail_fast, jobs=args.jobs))
+      manager.accept(summary_visitor)
+    else:
+      success = manager.accept(
+          testplan.MultiVisitor(runner.Visitor(args.fail_fast),
+                                summary_visitor))
   except KeyboardInterrupt:
     print('\nkeyboard interrupt; aborting')
     exit(EXITCODE_USER_ABORT)
@@ -198,6 +206,16 @@ def parse_cli():
       help="print version number",
       action="store_true")
 
+  parser.add_argument(
+      "-j",
+      "--jobs",
+      metavar="JOBS",
+      type=int,
+      help=("number of test cases to run concurrently; with more than one " +
+            "job, cases within a suite run in separate processes (except " +
+            "those marked `serial`) (default: 1)"),
+      default=1)
+
   parser.add_argument(
       "--fail-fast",
       help=("stop execution as soon as any test case fails, preempting " +
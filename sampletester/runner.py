@@ -12,19 +12,82 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import concurrent.futures
 import logging
+import multiprocessing
+import os
 import yaml
 
 from sampletester import caserunner
 from sampletester import testplan
 
 
+def _run_case(case: caserunner.TestCase):
+  """Runs `case` and returns it; used to marshal results back from workers."""
+  case.run()
+  return case
+
+
+# The process pool persists across run_all invocations so that workers are
+# created once per process, not once per suite. With the 'fork' start method
+# (POSIX), each worker is forked from this already-initialized interpreter,
+# skipping interpreter startup and re-imports entirely; elsewhere the default
+# start method is used.
+_pool = None
+_pool_max_workers = None
+
+
+def _get_pool(max_workers):
+  global _pool, _pool_max_workers
+  if _pool is None or _pool_max_workers != max_workers:
+    if _pool is not None:
+      _pool.shutdown()
+    mp_context = None
+    if 'fork' in multiprocessing.get_all_start_methods():
+      mp_context = multiprocessing.get_context('fork')
+    _pool = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+                                                   mp_context=mp_context)
+    _pool_max_workers = max_workers
+  return _pool
+
+
+def run_all(cases, max_workers=None):
+  """Runs the given `caserunner.TestCase`s, parallelizing where possible.
+
+  Cases not marked `serial` are dispatched to a process pool of up to
+  `max_workers` workers (by default, two fewer than the number of CPUs); serial
+  cases then run in the calling process, in order. Since workers operate on
+  pickled copies, callers must use the returned cases, not the ones passed in.
+
+  Returns the completed cases, in the same order they were given.
+  """
+  if max_workers is None:
+    max_workers = max(1, (os.cpu_count() or 1) - 2)
+
+  completed = {}
+  parallel = [(idx, case) for idx, case in enumerate(cases) if not case.serial]
+  if parallel:
+    pool = _get_pool(max_workers)
+    futures = {idx: pool.submit(_run_case, case) for idx, case in parallel}
+    for idx, future in futures.items():
+      completed[idx] = future.result()
+  for idx, case in enumerate(cases):
+    if case.serial:
+      completed[idx] = _run_case(case)
+  return [completed[idx] for idx in range(len(cases))]
+
+
 class Visitor(testplan.Visitor):
 
-  def __init__(self, fail_fast=False):
+  def __init__(self, fail_fast=False, jobs=1):
     self.run_passed = True
     self.fail_fast = fail_fast
     self.encountered_failure = False
+    self.jobs = jobs
+
+    # (testplan.TestCase, caserunner.TestCase) pairs deferred for parallel
+    # execution at the end of the current suite, when jobs > 1.
+    self.pending_cases = []
 
   def start_visit(self):
     logging.info("========== Running test!")
@@ -75,9 +138,17 @@ class Visitor(testplan.Visitor):
     tcase.attempted = True
     case_runner = caserunner.TestCase(environment.config, idx, tcase.name(),
                                       suite.setup(), tcase.spec(),
-                                      suite.teardown())
+                                      suite.teardown(), serial=tcase.serial(),
+                                      batch_calls=tcase.batch_calls())
     tcase.runner = case_runner
+    if self.jobs > 1:
+      self.pending_cases.append((tcase, case_runner))
+      return
     case_runner.run()
+    self.record_case(tcase, case_runner, suite)
+
+  def record_case(self, tcase: testplan.TestCase,
+                  case_runner: caserunner.TestCase, suite: testplan.Suite):
     num_failures = len(case_runner.failures)
     tcase.num_failures += num_failures
     suite.num_failures += tcase.num_failures
@@ -97,6 +168,14 @@ class Visitor(testplan.Visitor):
 
   def visit_suite_end(self, idx, suite: testplan.Suite,
                       do_suite: bool, environment: testplan.Environment):
+    if self.pending_cases:
+      pending, self.pending_cases = self.pending_cases, []
+      completed = run_all([case_runner for _, case_runner in pending],
+                          max_workers=self.jobs)
+      for (tcase, _), case_runner in zip(pending, completed):
+        tcase.runner = case_runner
+        self.record_case(tcase, case_runner, suite)
+
     if suite.success():
       logging.info(
           "==== SUITE {}:{}:{} SUCCESS ========================================"
@@ -116,7 +195,7 @@ class Visitor(testplan.Visitor):
       logging.info(
           "==== SUITE {}:{}:{} FAILURE ========================================"
           .format(environment.name(), idx, suite.name()))
-      suite.completed = True
+    suite.completed = True
 
   def visit_environment_end(self, environment: testplan.Environment, do_environment: bool):
     if not environment.success():
@@ -115,6 +115,15 @@ class TestCase(Wrapper):
   def spec(self):
     return self.config.get(CASE_SPEC, "")
 
+  def serial(self):
+    """Whether this case must not run concurrently with other cases."""
+    return self.config.get(CASE_SERIAL, False)
+
+  def batch_calls(self):
+    """Whether this case's consecutive call_may_fail directives may run
+    their external calls concurrently."""
+    return self.config.get(CASE_BATCH_CALLS, False)
+
 def passes_filter(filter: str, name: str):
   if not filter:
     return True
@@ -222,6 +231,8 @@ SUITE_SOURCE = "source"
 SUITE_CASES = "cases"
 CASE_NAME = "name"
 CASE_SPEC = "spec"
+CASE_SERIAL = "serial"
+CASE_BATCH_CALLS = "batch_calls"
 
 class Manager:
   """Hosts Visitors to a Wrapper hierarchy"""
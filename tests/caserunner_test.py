@@ -132,7 +132,7 @@ class TestCaseRunnerSkipsCasesWhenSetupFails(unittest.TestCase):
                        'expected test suite to fail: {}'.format(suite_name))
       self.assertFalse(self.results.cases[case_name].success(),
                        'expected test case to fail: {}'.format(case_name))
-      case_output = self.results.cases[case_name].runner.output
+      case_output = self.results.cases[case_name].runner.get_output()
       fname_match = self.fname_re.search(case_output)
       self.assertFalse(fname_match is None, 'could not extract filename in output:>>>\n{}\n<<<'.format(case_output))
       fname = fname_match.group(1)
@@ -169,6 +169,78 @@ class TestCaseRunnerCatchExceptions(unittest.TestCase):
     for _, tcase in self.results.cases.items():
       self.assertFalse(tcase.completed, 'keyboard interrupt should cause incomplete test case')
 
+class TestCaseRunnerParallel(unittest.TestCase):
+  def setUp(self):
+    self.environment_registry = environment_registry.new(convention.DEFAULT, [])
+    self.manager = testplan.Manager(
+        self.environment_registry,
+        testplan.suites_from([full_path('testdata/caserunner_parallel_test.yaml')]))
+    self.results = Visitor()
+    self.manager.accept(runner.Visitor(jobs=2))
+    if self.manager.accept(self.results) is not None:
+      self.fail('error running test plan: {}'.format(self.results.error))
+
+  def test_parallel_cases_pass(self):
+    self.assertTrue(len(self.results.cases) > 0)
+    for case_name, tcase in self.results.cases.items():
+      self.assertTrue(tcase.completed,
+                      'expected test case to complete: {}'.format(case_name))
+      self.assertTrue(tcase.success(),
+                      'expected test case to pass: {}'.format(case_name))
+
+  def test_summary_after_parallel_run(self):
+    # Mirrors cli.py for jobs > 1: the summary runs in a second pass after
+    # the runner pass, since case execution is deferred within each suite.
+    summary_visitor = summary.SummaryVisitor(verbosity=summary.Detail.FULL,
+                                             show_errors=True)
+    self.manager.accept(summary_visitor)
+    self.assertIn('PASSED', summary_visitor.output())
+    self.assertNotIn('RUNNING', summary_visitor.output())
+
+
+class TestCaseRunnerBatchedCalls(unittest.TestCase):
+  def setUp(self):
+    self.environment_registry = environment_registry.new(convention.DEFAULT, [full_path('testdata/caserunner_batch_test.manifest.yaml')])
+    self.manager = testplan.Manager(
+        self.environment_registry,
+        testplan.suites_from([full_path('testdata/caserunner_batch_test.yaml')]))
+    self.results = Visitor()
+    self.manager.accept(testplan.MultiVisitor(runner.Visitor(),
+                                              summary.SummaryVisitor(verbosity=summary.Detail.FULL,
+                                                                     show_errors=True)))
+    if self.manager.accept(self.results) is not None:
+      self.fail('error running test plan: {}'.format(self.results.error))
+
+  def test_unbatched_case_passes(self):
+    tcase = self.results.cases['shell:Batching passing suite:code']
+    self.assertTrue(tcase.success(),
+                    'expected the unbatched case to pass')
+
+  def test_batched_calls_keep_directive_order(self):
+    tcase = self.results.cases['shell:Batching passing suite:yaml']
+    self.assertTrue(tcase.success(),
+                    'expected the batched case to pass')
+    output = tcase.runner.get_output()
+    positions = [output.index(word) for word in ['alpha', 'beta', 'gamma']]
+    self.assertEqual(positions, sorted(positions),
+                     'expected batched call output in directive order, got:>>>\n{}\n<<<'.format(output))
+
+  def test_dependent_call_sees_batched_output(self):
+    # The final call_may_fail reads _last_call_output, so it is excluded from
+    # the batch and must see 'gamma', the output of the last batched call.
+    # The code assertion in the testplan enforces this; a failure there would
+    # make the case fail above, but check the echoed output here too.
+    tcase = self.results.cases['shell:Batching passing suite:yaml']
+    output = tcase.runner.get_output()
+    self.assertTrue(output.index('gamma') < output.rindex('gamma'),
+                    'expected the dependent call to echo the batched output:>>>\n{}\n<<<'.format(output))
+
+  def test_batched_call_error_surfaces(self):
+    tcase = self.results.cases['shell:Batching erroring suite:yaml']
+    self.assertTrue(tcase.num_errors > 0,
+                    'expected an unresolvable batched call to error the case')
+
+
 class TestCaseRunnerNoMatchForCallTarget(unittest.TestCase):
   def setUp(self):
     self.environment_registry = environment_registry.new(convention.DEFAULT,  [full_path('testdata/caserunner_test_target.manifest.yaml')])